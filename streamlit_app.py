@@ -1,14 +1,20 @@
+import os
+import re
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import NamedTuple
+
 import streamlit as st
-import pandas as pd
 import numpy as np
-import plotly.express as px
 import plotly.graph_objects as go
-from pypdf import PdfReader
+import pypdfium2 as pdfium
+from streamlit.runtime.uploaded_file_manager import UploadedFile
 
 st.set_page_config(page_title="Fidelity Pre-Ratings Engine // dexdogs", layout="wide")
 
 # --- CUSTOM CSS (Light Theme) ---
-st.markdown("""
+CSS = """
     <style>
     /* Main Background */
     .main { 
@@ -42,11 +48,39 @@ st.markdown("""
         border-radius: 10px; 
     }
     </style>
-    """, unsafe_allow_html=True)
+    """
+
+# Re-emitted every run on purpose: skipping it (e.g. behind a cache or a
+# session_state guard) would drop the style element from that rerun's
+# page. Identical markdown is deduplicated by Streamlit's element diff,
+# so the repeat call costs no frontend update.
+st.markdown(CSS, unsafe_allow_html=True)
 
 st.title("Fidelity Pre-Ratings Engine Demo // dexdogs")
 st.caption("Predicting AAA-D Market Ratings: Manual & EPD Input Simulation")
 
+# --- STATIC REFERENCE DATA ---
+PROJECT_TYPES = ["Biochar", "Afforestation (ARR)", "Renewable Energy", "Concrete/Construction"]
+SOURCE_OPTIONS = ["A. Direct Sensor (IoT) / Remote Sensing",
+                  "B. Metered / Hybrid Data",
+                  "C. Engineering Estimates / Secondary"]
+AUDIT_OPTIONS = ["L3: Reasonable Assurance (ISO 14064-3)",
+                 "L2: Limited Assurance / Self-Declared",
+                 "L1: Unverified"]
+
+# Option label -> (score, short label), keyed on the full selectbox text
+# so renaming an option can't silently fall through a substring match.
+SOURCE_SCORES = {
+    SOURCE_OPTIONS[0]: (40, "A. Direct Sensor (Primary)"),
+    SOURCE_OPTIONS[1]: (10, "B. Metered (Hybrid)"),
+    SOURCE_OPTIONS[2]: (-10, "C. Estimates (Secondary)"),
+}
+AUDIT_SCORES = {
+    AUDIT_OPTIONS[0]: (30, "L3: Reasonable Assurance"),
+    AUDIT_OPTIONS[1]: (15, "L2: Limited Assurance"),
+    AUDIT_OPTIONS[2]: (-20, "L1: Unverified"),
+}
+
 # --- GLOBAL VARIABLES ---
 score_audit = 0
 score_source = 0
@@ -66,38 +100,15 @@ with st.sidebar:
     if input_mode == "Manual Entry":
         is_manual = True
         st.subheader("Manual Parameters")
-        project_type = st.selectbox("Project Type", 
-                                  ["Biochar", "Afforestation (ARR)", "Renewable Energy", "Concrete/Construction"])
-        
+        project_type = st.selectbox("Project Type", PROJECT_TYPES)
+
         # Data Source (The Raters)
-        source_input = st.selectbox("Data Source Type", 
-                                   ["A. Direct Sensor (IoT) / Remote Sensing", 
-                                    "B. Metered / Hybrid Data", 
-                                    "C. Engineering Estimates / Secondary"], index=2)
-        if "Sensor" in source_input: 
-            score_source = 40
-            source_label = "A. Direct Sensor (Primary)"
-        elif "Metered" in source_input: 
-            score_source = 10
-            source_label = "B. Metered (Hybrid)"
-        else: 
-            score_source = -10
-            source_label = "C. Estimates (Secondary)"
+        source_input = st.selectbox("Data Source Type", SOURCE_OPTIONS, index=2)
+        score_source, source_label = SOURCE_SCORES[source_input]
 
         # Verification (The 'Sylvera' Factor)
-        audit_input = st.selectbox("Verification Level", 
-                                  ["L3: Reasonable Assurance (ISO 14064-3)", 
-                                   "L2: Limited Assurance / Self-Declared", 
-                                   "L1: Unverified"], index=2)
-        if "Reasonable" in audit_input: 
-            score_audit = 30
-            audit_label = "L3: Reasonable Assurance"
-        elif "Limited" in audit_input: 
-            score_audit = 15
-            audit_label = "L2: Limited Assurance"
-        else: 
-            score_audit = -20
-            audit_label = "L1: Unverified"
+        audit_input = st.selectbox("Verification Level", AUDIT_OPTIONS, index=2)
+        score_audit, audit_label = AUDIT_SCORES[audit_input]
 
         # Frequency
         freq_input = st.slider("Data Granularity (Freq)", 0, 100, 20, help="0=Annual, 100=Real-time")
@@ -111,23 +122,106 @@ with st.sidebar:
         st.info("Upload a PDF to auto-extract fidelity attributes using text scanning.")
 
 # --- EPD PARSING LOGIC ---
-def analyze_epd(file):
-    reader = PdfReader(file)
-    text = ""
-    for page in reader.pages:
-        text += page.extract_text().lower()
-    
+@st.cache_resource(show_spinner=False)
+def fidelity_markers():
+    # Streamlit re-executes the whole script on every rerun, so a bare
+    # module-level compile would repeat; cache_resource builds the
+    # pattern once per server process and shares it across sessions.
+    # Single alternation so the text is scanned once in C instead of
+    # once per keyword.
+    return re.compile(
+        r"\b(concrete|cement|glass|steel"
+        r"|third party verified|external verification|iso 14040|iso 14044"
+        r"|primary data|site-specific|secondary data|database)\b"
+    )
+
+# Marker groups per classification category; scanning can stop once
+# every category has at least one hit.
+PROJECT_MARKERS = frozenset({"concrete", "cement", "glass", "steel"})
+AUDIT_MARKERS = frozenset({"third party verified", "external verification",
+                           "iso 14040", "iso 14044"})
+SOURCE_MARKERS = frozenset({"primary data", "site-specific",
+                            "secondary data", "database"})
+
+# Below this page count the pool spin-up costs more than it saves.
+PARALLEL_PAGE_THRESHOLD = 8
+# Keep reading at least this far so a sparse cover page can't end the scan.
+MIN_SCAN_PAGES = 3
+
+def _resolved(hits):
+    return (not hits.isdisjoint(PROJECT_MARKERS)
+            and not hits.isdisjoint(AUDIT_MARKERS)
+            and not hits.isdisjoint(SOURCE_MARKERS))
+
+def _page_text(pdf, index):
+    # get_text_range pulls the whole page in one FFI call; closing the
+    # page and textpage eagerly releases PDFium's off-heap buffers
+    # instead of leaving them to GC finalizers.
+    page = pdf[index]
+    textpage = page.get_textpage()
+    try:
+        return textpage.get_text_range()
+    finally:
+        textpage.close()
+        page.close()
+
+def _extract_page_range(file_bytes, start, stop):
+    # Worker opens its own document: PDFium is not thread-safe, so pages
+    # are split across processes rather than threads.
+    pdf = pdfium.PdfDocument(file_bytes)
+    return [_page_text(pdf, i) for i in range(start, stop)]
+
+# Hash uploads by their upload ID instead of serializing the payload, so
+# cache keying never copies or digests the PDF bytes.
+@st.cache_data(show_spinner=False, max_entries=32,
+               hash_funcs={UploadedFile: lambda f: f.file_id})
+def scan_epd_markers(uploaded):
+    # Scans page by page and stops as soon as every marker category is
+    # covered, so front-loaded EPDs don't pay for their appendices.
+    markers = fidelity_markers()
+    uploaded.seek(0)
+    # PdfDocument reads the stream directly; only the parallel branch
+    # materializes the bytes, since workers need a picklable payload.
+    pdf = pdfium.PdfDocument(uploaded)
+    n_pages = len(pdf)
+    hits = set()
+    if n_pages <= PARALLEL_PAGE_THRESHOLD:
+        for i in range(n_pages):
+            hits.update(markers.findall(_page_text(pdf, i).lower()))
+            if i + 1 >= MIN_SCAN_PAGES and _resolved(hits):
+                break
+    else:
+        file_bytes = uploaded.getvalue()
+        n_workers = min(os.cpu_count() or 1, n_pages)
+        bounds = [round(n_pages * w / n_workers) for w in range(n_workers + 1)]
+        with ProcessPoolExecutor(max_workers=n_workers) as ex:
+            for chunk in ex.map(_extract_page_range, repeat(file_bytes),
+                                bounds[:-1], bounds[1:]):
+                for text in chunk:
+                    hits.update(markers.findall(text.lower()))
+                if _resolved(hits):
+                    break
+    return frozenset(hits)
+
+class EPDFeatures(NamedTuple):
+    project_type: str
+    audit_label: str
+    audit_score: int
+    source_label: str
+    source_score: int
+
+def classify_epd(hits):
     # 1. DETECT PROJECT
     p_type = "General Construction"
-    if "concrete" in text or "cement" in text: p_type = "Concrete / Cement"
-    elif "glass" in text: p_type = "Glass Manufacturing"
-    elif "steel" in text: p_type = "Metals / Steel"
-    
+    if "concrete" in hits or "cement" in hits: p_type = "Concrete / Cement"
+    elif "glass" in hits: p_type = "Glass Manufacturing"
+    elif "steel" in hits: p_type = "Metals / Steel"
+
     # 2. DETECT VERIFICATION
-    if "third party verified" in text or "external verification" in text:
+    if "third party verified" in hits or "external verification" in hits:
         a_lbl = "L3: Third-Party Verified (ISO 14025)"
         a_scr = 30
-    elif "iso 14040" in text or "iso 14044" in text:
+    elif "iso 14040" in hits or "iso 14044" in hits:
         a_lbl = "L2: Self-Declared (ISO Compliant)"
         a_scr = 15
     else:
@@ -135,40 +229,108 @@ def analyze_epd(file):
         a_scr = -20
 
     # 3. DETECT SOURCE
-    if "primary data" in text or "site-specific" in text:
+    if "primary data" in hits or "site-specific" in hits:
         s_lbl = "A. Direct Facility Data (Primary)"
         s_scr = 40
-    elif "secondary data" in text or "database" in text:
+    elif "secondary data" in hits or "database" in hits:
         s_lbl = "C. Industry Average (Secondary)"
         s_scr = -10
     else:
         s_lbl = "B. Hybrid / Mixed Data"
         s_scr = 10
-        
-    return p_type, a_lbl, a_scr, s_lbl, s_scr
+
+    return EPDFeatures(p_type, a_lbl, a_scr, s_lbl, s_scr)
+
+# --- RATING TABLE ---
+# Sorted thresholds + table lookup instead of an if-elif ladder; the same
+# tables can score whole arrays later via np.searchsorted.
+RATING_THRESHOLDS = [40, 60, 80]
+RATING_TABLE = [
+    ("D",   "#c0392b",  2.50),
+    ("BBB", "#f1c40f",  9.00),
+    ("A",   "#2ecc71", 14.20),
+    ("AAA", "#00d4ff", 18.50),
+]
+
+def get_rating(score):
+    return RATING_TABLE[bisect_right(RATING_THRESHOLDS, score)]
+
+BASE_SCORE = 40
+
+def _clamp(score):
+    # Branchy but call-free; min(max(...)) pays two builtin dispatches.
+    return 0.0 if score < 0 else 100.0 if score > 100 else score
+
+def calculate_fidelity(score_source, score_audit, score_freq):
+    return _clamp(BASE_SCORE + score_audit + score_source + score_freq)
+
+@st.cache_resource(show_spinner=False)
+def fidelity_grid():
+    # The manual inputs span only 3 sources x 3 audit levels x 101 slider
+    # stops, so every reachable score is precomputed once and a slider
+    # tick becomes a dict lookup. The grid itself is built as one
+    # broadcast-and-clip pass in numpy rather than a Python loop, so
+    # adding fidelity axes later doesn't blow up the build cost.
+    src_scores = np.array([SOURCE_SCORES[src][0] for src in SOURCE_OPTIONS])
+    aud_scores = np.array([AUDIT_SCORES[aud][0] for aud in AUDIT_OPTIONS])
+    freq_scores = np.arange(101) / 5
+    grid = np.clip(BASE_SCORE
+                   + src_scores[:, None, None]
+                   + aud_scores[None, :, None]
+                   + freq_scores[None, None, :], 0, 100)
+    keys = [(src, aud, freq)
+            for src in SOURCE_OPTIONS
+            for aud in AUDIT_OPTIONS
+            for freq in range(101)]
+    return dict(zip(keys, grid.ravel().tolist()))
+
+# --- FIGURE BUILDERS ---
+@st.cache_data(show_spinner=False)
+def build_gauge(score, color):
+    # Cached as a plain dict so rerenders skip figure construction and
+    # cache hits can't be mutated by the caller.
+    fig = go.Figure(go.Indicator(
+        mode = "gauge+number",
+        value = score,
+        title = {'text': "The Raters' Fidelity Confidence"},
+        gauge = {
+            'axis': {'range': [None, 100], 'tickcolor': "white"},
+            'bar': {'color': color},
+            'steps': [
+                {'range': [0, 40], 'color': '#333'},
+                {'range': [40, 70], 'color': '#555'},
+                {'range': [70, 100], 'color': '#777'}],
+            'threshold': {'line': {'color': "white", 'width': 4}, 'thickness': 0.75, 'value': 80}
+        }
+    ))
+    fig.update_layout(paper_bgcolor="#000000", font={'color': "white"}, height=300, margin=dict(t=60,b=30))
+    return fig.to_dict()
 
 # --- MAIN EXECUTION ---
 run_dashboard = False
 
 if input_mode == "EPD Input" and uploaded_file is not None:
     with st.spinner("Scanning document for fidelity markers..."):
-        project_type, audit_label, score_audit, source_label, score_source = analyze_epd(uploaded_file)
+        features = classify_epd(scan_epd_markers(uploaded_file))
+        project_type = features.project_type
+        audit_label = features.audit_label
+        score_audit = features.audit_score
+        source_label = features.source_label
+        score_source = features.source_score
         score_freq = 5 # EPDs are usually static, so low frequency score
+        fidelity_score = calculate_fidelity(score_source, score_audit, score_freq)
         run_dashboard = True
 elif input_mode == "Manual Entry":
+    fidelity_score = fidelity_grid()[(source_input, audit_input, freq_input)]
     run_dashboard = True
 
 # --- DASHBOARD RENDER ---
-if run_dashboard:
-    # CALCULATE FINAL SCORES
-    base_score = 40
-    fidelity_score = min(max(base_score + score_audit + score_source + score_freq, 0), 100)
-    
+# Fragment boundary: reruns triggered from inside the dashboard replay
+# only this subtree instead of the whole script.
+@st.fragment
+def render_dashboard(project_type, audit_label, score_audit, source_label, score_source, score_freq, fidelity_score):
     # PRE-DETERMINE RATING
-    if fidelity_score >= 80: rating, color, price = "AAA", "#00d4ff", 18.50
-    elif fidelity_score >= 60: rating, color, price = "A", "#2ecc71", 14.20
-    elif fidelity_score >= 40: rating, color, price = "BBB", "#f1c40f", 9.00
-    else: rating, color, price = "D", "#c0392b", 2.50
+    rating, color, price = get_rating(fidelity_score)
 
     # SECTION 1: DATA INTELLIGENCE
     st.subheader(f"Analysis: {project_type}")
@@ -187,21 +349,7 @@ if run_dashboard:
         st.metric("Fidelity Score", f"{fidelity_score}/100")
 
     with row2_col2:
-        fig = go.Figure(go.Indicator(
-            mode = "gauge+number",
-            value = fidelity_score,
-            title = {'text': "The Raters' Fidelity Confidence"},
-            gauge = {
-                'axis': {'range': [None, 100], 'tickcolor': "white"},
-                'bar': {'color': color},
-                'steps': [
-                    {'range': [0, 40], 'color': '#333'},
-                    {'range': [40, 70], 'color': '#555'},
-                    {'range': [70, 100], 'color': '#777'}],
-                'threshold': {'line': {'color': "white", 'width': 4}, 'thickness': 0.75, 'value': 80}
-            }
-        ))
-        fig.update_layout(paper_bgcolor="#000000", font={'color': "white"}, height=300, margin=dict(t=60,b=30))
+        fig = go.Figure(build_gauge(fidelity_score, color))
         st.plotly_chart(fig, use_container_width=True)
 
     # SECTION 3: GAP ANALYSIS & ADVICE
@@ -215,6 +363,8 @@ if run_dashboard:
     else:
         st.success("Configuration meets Top-Tier market fidelity standards.")
 
+if run_dashboard:
+    render_dashboard(project_type, audit_label, score_audit, source_label, score_source, score_freq, fidelity_score)
 else:
     # IDLE STATE
     st.info("Select an input method in the sidebar to begin.")